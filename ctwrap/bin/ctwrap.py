@@ -4,7 +4,6 @@
 
 import argparse
 import os
-import ctwrap
 
 import warnings
 warnings.filterwarnings(action='once')
@@ -51,6 +50,9 @@ def main():
     else:
         output_file = args.output
 
+    # import ctwrap only after arguments are parsed (fast `--help`)
+    import ctwrap
+
     # import module
     if '.' not in module_name:
         module_name = 'ctwrap.modules.' + module_name
@@ -29,8 +29,12 @@ def ls(iname, path=None):
         raise RuntimeError('unknown file format `{}`'.format(frmt))
 
 
-def save(oname, data, mode='a', force=True, path=None):
-    """Save data to file / file structure"""
+def save(oname, data, mode='a', force=True, path=None, **kwargs):
+    """Save data to file / file structure
+
+    Additional keyword arguments (e.g. compression settings) are passed to
+    the hdf writer and are ignored for other file formats.
+    """
 
     if oname is None:
         return
@@ -40,7 +44,7 @@ def save(oname, data, mode='a', force=True, path=None):
 
     # save configuration to output file
     if frmt in {'.h5', '.hdf5', '.hdf'}:
-        to_hdf(oname, data, mode=mode, force=force, path=path)
+        to_hdf(oname, data, mode=mode, force=force, path=path, **kwargs)
     elif frmt == '.xlsx':
         to_xlsx(oname, data, mode=mode, force=force, path=path)
     elif frmt == '.csv':
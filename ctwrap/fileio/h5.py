@@ -13,18 +13,42 @@ warnings.filterwarnings("ignore",
 # local imports
 from .yaml import flatten, nested
 
-__all__ = ['h5ls', 'to_hdf', 'from_hdf']
+__all__ = ['h5ls', 'to_hdf', 'from_hdf', 'merge_hdf']
 
 
-def _getfile(fname, path=None):
+def _getpath(fname, path=None):
     """helper function"""
 
     if path not in ['', None]:
         fname = (os.sep).join([path, fname])
 
+    return fname
+
+
+def _getfile(fname, path=None):
+    """helper function"""
+
+    fname = _getpath(fname, path=path)
+
     return fname, os.path.isfile(fname)
 
 
+def _cache_params(rdcc_nbytes=None,
+                  rdcc_nslots=None,
+                  rdcc_w0=None,
+                  mdc_nbytes=None):
+    """helper function translating cache settings to PyTables"""
+
+    params = {
+        'CHUNK_CACHE_SIZE': rdcc_nbytes,
+        'CHUNK_CACHE_NELMTS': rdcc_nslots,
+        'CHUNK_CACHE_PREEMPT': rdcc_w0,
+        'METADATA_CACHE_SIZE': mdc_nbytes,
+    }
+
+    return {k: v for k, v in params.items() if v is not None}
+
+
 def h5ls(iname, path=None):
     """Retrieve names of groups within a hdf file."""
 
@@ -42,37 +66,104 @@ def h5ls(iname, path=None):
     return groups
 
 
-def to_hdf(oname, groups, path=None, mode='a', force=True):
-    """Write content to group(s) of hdf5 container """
-
-    # file check
-    fname, fexists = _getfile(oname, path=path)
-    if fexists and mode == 'w' and not force:
+def to_hdf(oname,
+           groups,
+           path=None,
+           mode='a',
+           force=True,
+           complib=None,
+           complevel=None,
+           rdcc_nbytes=None,
+           rdcc_nslots=None,
+           rdcc_w0=None,
+           mdc_nbytes=None):
+    """Write content to group(s) of hdf5 container
+
+    Compression is specified by `complib` (e.g. 'blosc:zstd' or 'zlib') and
+    `complevel` (0-9), which are passed to pandas/PyTables. The chunk cache
+    is set by `rdcc_nbytes` (size in bytes), `rdcc_nslots` (number of hash
+    table slots) and `rdcc_w0` (preemption policy), analogous to h5py;
+    `mdc_nbytes` sets the size of the metadata cache (in bytes).
+    """
+
+    # file check (only needed if an existing file is protected)
+    fname = _getpath(oname, path=path)
+    if mode == 'w' and not force and os.path.isfile(fname):
         msg = 'Cannot overwrite existing file `{}` (use force to override)'
         raise RuntimeError(msg.format(oname))
 
-    existing = h5ls(fname)
-    for g in groups:
-
-        if mode == 'a' and g in existing and not force:
-            msg = 'Cannot overwrite existing group `{}` (use force to override)'
-            raise RuntimeError(msg.format(g))
-
-        data = groups[g]
-        if isinstance(data, dict):
-            data = pd.Series(flatten(data))
-            data.to_hdf(fname, g, mode=mode)
-        elif isinstance(data, (pd.DataFrame, pd.Series)):
-            data.to_hdf(fname, g, mode=mode)
-        elif data is None:
-            # print('no data frame')
-            pass
-        else:
-            # ignore anything else
-            pass
-
-        # prevent overwriting of existing groups
-        mode = 'a'
+    # existing groups are checked using the open file handle
+    params = _cache_params(rdcc_nbytes, rdcc_nslots, rdcc_w0, mdc_nbytes)
+    with pd.HDFStore(fname, mode=mode, complib=complib, complevel=complevel,
+                     **params) as hdf:
+        for g in groups:
+
+            if not force and mode == 'a' and g in hdf:
+                msg = 'Cannot overwrite existing group `{}` (use force to override)'
+                raise RuntimeError(msg.format(g))
+
+            data = groups[g]
+            if isinstance(data, dict):
+                data = pd.Series(flatten(data))
+                hdf.put(g, data)
+            elif isinstance(data, (pd.DataFrame, pd.Series)):
+                hdf.put(g, data)
+            elif data is None:
+                # print('no data frame')
+                pass
+            else:
+                # ignore anything else
+                pass
+
+
+def merge_hdf(oname,
+              inames,
+              path=None,
+              force=True,
+              remove=False,
+              complib=None,
+              complevel=None,
+              rdcc_nbytes=None,
+              rdcc_nslots=None,
+              rdcc_w0=None,
+              mdc_nbytes=None):
+    """Merge groups of hdf containers into a single hdf container
+
+    Groups are copied node by node using PyTables, i.e. data are not
+    converted to pandas objects. External links are not used as linked
+    groups are not listed by pandas (see `h5ls` and `from_hdf`).
+    """
+
+    import tables
+
+    fname = _getpath(oname, path=path)
+
+    filters = None
+    if complib:
+        filters = tables.Filters(complevel=complevel or 0, complib=complib)
+
+    params = _cache_params(rdcc_nbytes, rdcc_nslots, rdcc_w0, mdc_nbytes)
+    with tables.open_file(fname, mode='a', **params) as out:
+        for iname in inames:
+
+            iname, fexists = _getfile(iname, path=path)
+            if not fexists:
+                continue
+
+            with tables.open_file(iname, mode='r') as hdf:
+                for g in hdf.root._v_groups:
+
+                    if '/' + g in out:
+                        if not force:
+                            msg = 'Cannot overwrite existing group `{}` (use force to override)'
+                            raise RuntimeError(msg.format(g))
+                        out.remove_node('/', g, recursive=True)
+
+                    hdf.copy_node('/', name=g, newparent=out.root,
+                                  recursive=True, filters=filters)
+
+            if remove:
+                os.remove(iname)
 
 
 def from_hdf(iname, path=None):
@@ -6,6 +6,7 @@ import os
 import re
 from ruamel import yaml
 from copy import deepcopy
+from functools import lru_cache
 
 __all__ = ['load_yaml', 'flatten', 'nested']
 
@@ -25,15 +26,28 @@ def load_yaml(fname, path=None, keys=None):
     elif path not in ['', None]:
         fname = (os.sep).join([path, fname])
 
-    with open(fname) as yml:
-        out = yaml.load(yml, Loader=yaml.SafeLoader)
+    # parsed content is cached based on file name and modification time
+    fname = os.path.abspath(fname)
+    out = _load_yaml_cached(fname, os.stat(fname).st_mtime_ns)
 
+    # return copies, as callers may modify content
     if keys is None:
-        return out
+        return deepcopy(out)
     else:
         return tuple([deepcopy(out[k]) for k in keys])
 
 
+@lru_cache(maxsize=128)
+def _load_yaml_cached(fname, mtime_ns):
+    """Parse yaml file (hidden function; cached)"""
+
+    with open(fname) as yml:
+        return yaml.load(yml, Loader=yaml.SafeLoader)
+
+
+load_yaml.cache_clear = _load_yaml_cached.cache_clear
+
+
 def flatten(d):
     """Flatten nested dictionary (recursive function)"""
 
@@ -3,13 +3,13 @@
 """Object handling variations."""
 
 import os
+import sys
+import importlib
+import pickle
 from copy import deepcopy
+from functools import lru_cache
 import warnings
 
-# multiprocessing
-import multiprocessing as mp
-import queue  # imported for using queue.Empty exception
-
 # ctwrap specific imports
 from . import fileio
 
@@ -18,6 +18,9 @@ __all__ = ['Simulation', 'SimulationHandler']
 indent1 = ' * '
 indent2 = '   - '
 
+# maximum number of simulation results saved at once
+FLUSH_BATCH = 16
+
 
 class Simulation(object):
     """The Simulation class wraps modules into an object.
@@ -26,6 +29,11 @@ class Simulation(object):
         data (dict): dictionary of pandas.DataFrame objects
 
     Required module functions 'run' and 'defaults' are passed through
+
+    Configurations generated by `SimulationHandler` share unchanged entries
+    with the handler defaults, i.e. the module function 'run' must not
+    modify its arguments. Modules that do so need to set the attribute
+    `run.mutates_config = True`, in which case a deep copy is passed.
     """
 
     def __init__(self, module, output=None):
@@ -41,10 +49,26 @@ class Simulation(object):
         for attr in ['defaults', 'run']:
             assert hasattr(module, attr), msg.format(module.__name__, attr)
 
-        self._module = module
+        self._module_name = module.__name__
+        self._module_obj = module
         self._output = output
+        self._lock = None  # serializes saving across processes
         self.data = None
 
+    def __getstate__(self):
+        """Drop module handle (re-imported on demand) and lock when pickling"""
+        state = self.__dict__.copy()
+        state['_module_obj'] = None
+        state['_lock'] = None
+        return state
+
+    @property
+    def _module(self):
+        """Handle to module running the simulation"""
+        if self._module_obj is None:
+            self._module_obj = importlib.import_module(self._module_name)
+        return self._module_obj
+
     @classmethod
     def from_module(cls, module, output=None):
         """Alternative constructor for `Simulation` object.
@@ -61,7 +85,7 @@ class Simulation(object):
         name = module.__name__.split('.')[-1]
         name = ''.join([m.title() for m in name.split('_')])
 
-        return type(name, (cls, ), {})(module, output)
+        return _subclass(cls, name)(module, output)
 
     def run(self, name='defaults', config=None, **kwargs):
         """Run function holding configuration in dictionary.
@@ -75,24 +99,77 @@ class Simulation(object):
 
         if config is None:
             config = self._module.defaults()
+        elif getattr(self._module.run, 'mutates_config', False):
+            config = deepcopy(config)
 
         self.data = self._module.run(name, **config, **kwargs)
 
+    def run_many(self, configs, **kwargs):
+        """Run and save a sequence of simulations.
+
+        Results are saved in batches of up to `FLUSH_BATCH` simulations;
+        a batch is saved early if a group name would be repeated.
+
+        Args:
+           configs (iterable): tuples holding name and configuration
+        Kwargs:
+           kwargs (optional): depends on implementation of __init__
+        """
+
+        batch = {}
+        count = 0
+        try:
+            for name, config in configs:
+                self.run(name, config, **kwargs)
+
+                # flush early rather than replacing results within a batch
+                data = self.data or {}
+                if any(g in batch for g in data):
+                    batch, pending = {}, batch
+                    count = 0
+                    self._save(pending)
+
+                batch.update(data)
+                count += 1
+                if count == FLUSH_BATCH:
+                    batch, pending = {}, batch
+                    count = 0
+                    self._save(pending)
+        finally:
+            # results of completed simulations are kept if one fails
+            if batch:
+                self._save(batch)
+
     def defaults(self):
         """Pass-through returning module defaults as a dictionary"""
         return self._module.defaults()
 
-    def _save(self):
+    def _save(self, data=None):
         """Save simulation data (hidden)"""
 
         if self._output is None:
             return
 
+        if data is None:
+            data = self.data
+
         oname = self._output['file_name']
         opath = self._output['path']
         force = self._output['force_overwrite']
+        opts = self._output.get('h5_opts', {})
+
+        if self._lock is None:
+            fileio.save(oname, data, mode='a', force=force, path=opath, **opts)
+        else:
+            with self._lock:
+                fileio.save(oname, data, mode='a', force=force, path=opath,
+                            **opts)
+
 
-        fileio.save(oname, self.data, mode='a', force=force, path=opath)
+@lru_cache(maxsize=None)
+def _subclass(cls, name):
+    """Create renamed subclass (hidden function; cached)"""
+    return type(name, (cls, ), {})
 
 
 class SimulationHandler(object):
@@ -127,8 +204,15 @@ class SimulationHandler(object):
             assert key in variation, msg.format(key)
 
         self._entry = variation['entry']
+        self._entry_path = tuple(self._entry.split('.'))
+        self._config_cache = {}
         self._values = variation['values']
 
+        # task names and values of variation
+        e = self._entry
+        self._tasks = {'{}_{}'.format(e, v): v for v in self._values or []}
+        self._sorted_tasks = sorted(self._tasks)
+
         # vals = self._variation_tuple[1]
         if self.verbosity and self._values is not None:
             print('Simulations for entry `{}` with values: {}'.format(
@@ -136,22 +220,19 @@ class SimulationHandler(object):
 
         if self._output is not None:
 
-            var = variation.copy()
-            var['tasks'] = [t for t in self.tasks]
-            var['tasks'].sort()
-
             # assemble information
             info = {
                 'defaults': self._defaults,
-                'variation': var,
+                'variation': {**variation, 'tasks': list(self._sorted_tasks)},
             }
 
             # save to file
             oname = self._output['file_name']
             path = self._output['path']
             force = self._output['force_overwrite']
+            opts = self._output.get('h5_opts', {})
 
-            fileio.save(oname, info, mode='w', force=force, path=path)
+            fileio.save(oname, info, mode='w', force=force, path=path, **opts)
 
     @classmethod
     def from_yaml(cls, yaml_file, name=None, path=None, **kwargs):
@@ -215,6 +296,40 @@ class SimulationHandler(object):
             out['format'] = ''
         if 'force_overwrite' not in out:
             out['force_overwrite'] = True
+        if 'parallel_strategy' not in out:
+            out['parallel_strategy'] = 'file_per_process'
+        if out['parallel_strategy'] not in ['file_per_process', 'lock']:
+            msg = 'unknown parallel strategy `{}`'
+            raise RuntimeError(msg.format(out['parallel_strategy']))
+
+        # hdf compression: 'compression' specifies the PyTables library
+        # (e.g. 'blosc:zstd', 'zlib' or None), 'compression_opts' the level
+        if 'compression' not in out:
+            out['compression'] = 'blosc:zstd'
+        if 'compression_opts' not in out:
+            out['compression_opts'] = 5
+        complib = out['compression']
+        if complib == 'gzip':
+            complib = 'zlib'
+        out['h5_opts'] = {
+            'complib': complib,
+            'complevel': out['compression_opts'] if complib else None,
+        }
+
+        # hdf chunk cache: 'hdf5_rdcc' holds 'rdcc_nbytes' (cache size in
+        # bytes), 'rdcc_nslots' (hash table slots) and 'rdcc_w0' (eviction
+        # preference for fully written chunks); the HDF5 default of 1 MiB is
+        # too small for large chunked datasets
+        rdcc = {'rdcc_nbytes': 32 << 20, 'rdcc_nslots': 100003, 'rdcc_w0': .9}
+        rdcc.update(out.get('hdf5_rdcc') or {})
+        out['hdf5_rdcc'] = rdcc
+        out['h5_opts'].update(rdcc)
+
+        # hdf metadata cache: 'hdf5_mdc_nbytes' (cache size in bytes); a
+        # larger cache aggregates metadata flushes for files with many groups
+        if 'hdf5_mdc_nbytes' not in out:
+            out['hdf5_mdc_nbytes'] = 8 << 20
+        out['h5_opts']['mdc_nbytes'] = out['hdf5_mdc_nbytes']
 
         fformat = out['format']
 
@@ -256,39 +371,32 @@ class SimulationHandler(object):
     def __iter__(self):
         """Returns itself as iterator"""
 
-        for task in self.tasks:
+        for task in self._tasks:
             yield task
 
     def __getitem__(self, task):
         return self.configuration(task)
 
     def configuration(self, task):
-        """Return """
+        """Return configuration for task"""
 
-        value = self.tasks.get(task, None)
-        assert task is not None, 'invalid value'
+        return deepcopy(self._configuration(task))
 
-        out = deepcopy(self._defaults)
+    def _configuration(self, task):
+        """Return configuration for task (hidden; cached)
 
-        # locate and replace entry in nested dictionary (recursive)
-        def replace_entry(nested, key_list, value):
-            sub = nested[key_list[0]]
-            if len(key_list) == 1:
-                if isinstance(sub, list):
-                    sub[0] = value
-                else:
-                    sub = value
-            else:
-                sub = replace_entry(sub, key_list[1:], value)
-            nested[key_list[0]] = sub
-            return nested
-
-        value = self.tasks[task]
-        entry = self._entry.split('.')
+        Only dictionaries along the path of the varied entry are copied;
+        all other content is shared with the defaults, i.e. configurations
+        must not be modified.
+        """
 
-        return replace_entry(out, entry, value)
+        config = self._config_cache.get(task)
+        if config is None:
+            value = self._tasks[task]
+            config = _replace_entry(self._entry_path)(self._defaults, value)
+            self._config_cache[task] = config
 
-        # return out
+        return config
 
     @property
     def verbose(self):
@@ -304,18 +412,18 @@ class SimulationHandler(object):
     @property
     def tasks(self):
         """values of variation"""
-        e = self._entry
-        return {'{}_{}'.format(e, v): v for v in self._values}
+        return self._tasks
 
     def run_task(self, sim, task, **kwargs):
 
-        assert task in self.tasks, 'unknown task `{}`'.format(task)
+        if not isinstance(sim, Simulation):
+            raise TypeError('need simulation object')
 
         # create a new simulation object
         obj = Simulation.from_module(sim._module, self._output)
 
         # run simulation
-        config = self.configuration(task)
+        config = self._configuration(task)
 
         obj.run(task, config, **kwargs)
         obj._save()
@@ -323,7 +431,8 @@ class SimulationHandler(object):
     def run_serial(self, sim, verbosity=None, **kwargs):
         """Run variation in series"""
 
-        assert isinstance(sim, Simulation), 'need simulation object'
+        if not isinstance(sim, Simulation):
+            raise TypeError('need simulation object')
 
         if verbosity is None:
             verbosity = self.verbosity
@@ -331,18 +440,14 @@ class SimulationHandler(object):
         # create a new simulation object
         obj = Simulation.from_module(sim._module, self._output)
 
-        tasks = [t for t in self.tasks]
-        tasks.sort()
-        for t in tasks:
-
-            if verbosity > 0:
-                print(indent1 + 'processing `{}`'.format(t))
-
-            # run simulation
-            config = self.configuration(t)
+        # configurations are generated as simulations are run
+        def configs():
+            for t in self._sorted_tasks:
+                if verbosity > 0:
+                    print(indent1 + 'processing `{}`'.format(t))
+                yield t, self._configuration(t)
 
-            obj.run(t, config, **kwargs)
-            obj._save()
+        obj.run_many(configs(), **kwargs)
 
         return True
 
@@ -350,13 +455,33 @@ class SimulationHandler(object):
                      sim,
                      number_of_processes=None,
                      verbosity=None,
+                     chunksize=None,
                      **kwargs):
-        """Run variation using multiprocessing"""
+        """Run variation using multiprocessing
+
+        By default, one process is used per CPU available to the current
+        process; simulations limited by I/O may benefit from a larger
+        `number_of_processes`.
+
+        Tasks are handed to idle workers in batches of `chunksize` tasks
+        (default: a quarter of the tasks per process, at most `FLUSH_BATCH`).
+        If run times vary strongly between tasks, `chunksize=1` balances
+        the load best.
+        """
 
-        assert isinstance(sim, Simulation), 'need simulation object'
+        import multiprocessing as mp
+        from concurrent.futures import ProcessPoolExecutor
+
+        if not isinstance(sim, Simulation):
+            raise TypeError('need simulation object')
 
         if number_of_processes is None:
-            number_of_processes = mp.cpu_count() // 2
+            # respect CPU affinity (e.g. cgroup or batch scheduler limits)
+            try:
+                number_of_processes = len(os.sched_getaffinity(0))
+            except AttributeError:
+                number_of_processes = os.cpu_count() or 1
+            number_of_processes = max(1, number_of_processes)
 
         if verbosity is None:
             verbosity = self.verbosity
@@ -365,72 +490,191 @@ class SimulationHandler(object):
             print(indent1 + 'running simulation using ' +
                   '{} cores'.format(number_of_processes))
 
-        # set up queues
-        tasks_to_accomplish = mp.Queue()
-        finished_tasks = mp.Queue()
-        tasks = [t for t in self.tasks]
-        tasks.sort()
-        for t in tasks:
-            config = self.configuration(t)
-            tasks_to_accomplish.put((t, config, kwargs))
-
-        lock = mp.Lock()
-
-        # creating processes
-        processes = []
-        for w in range(number_of_processes):
-            p = mp.Process(
-                target=worker,
-                args=(tasks_to_accomplish, finished_tasks, sim._module, lock,
-                      self._output, verbosity))
-            processes.append(p)
-            p.start()
-
-        # completing process
-        for p in processes:
-            p.join()
-
-        # print the output
-        while not finished_tasks.empty():
-            msg = finished_tasks.get()
-            if verbosity > 1:
-                print(indent2 + msg)
+        # tasks are dispatched by name and value; configurations are
+        # assembled by workers from defaults shipped once per process
+        tasks = [(t, self._tasks[t]) for t in self._sorted_tasks]
+
+        # hdf output is written to one file per worker process, which are
+        # merged once all tasks are completed; other output is locked
+        output = self._output
+        per_process = False
+        if output is not None and output['file_name'] is not None:
+            strategy = output.get('parallel_strategy', 'file_per_process')
+            per_process = (strategy == 'file_per_process' and
+                           output['format'] in ['h5', 'hdf', 'hdf5'])
+
+        # fork is used where available (copy-on-write memory); elsewhere
+        # workers are started using spawn
+        ctx = mp.get_context('fork' if sys.platform != 'win32' else 'spawn')
+        lock = None if per_process else ctx.Lock()
+
+        # workers register their output files when they are started
+        registry = ctx.SimpleQueue() if per_process else None
+
+        # dispatch tasks in batches to reduce inter-process communication;
+        # results of each batch are saved at once
+        if chunksize is None:
+            chunksize = max(1, len(tasks) // (4 * number_of_processes))
+            chunksize = min(chunksize, FLUSH_BATCH)
+        batches = [
+            tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)
+        ]
+
+        # settings shared by all tasks are serialized once
+        state = (sim._module_name, self._defaults, self._entry_path, output,
+                 verbosity, kwargs)
+        state = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # without fork, workers read serialized settings from shared memory
+        # (python >= 3.8) rather than receiving individual copies
+        shm = None
+        if ctx.get_start_method() != 'fork':
+            try:
+                from multiprocessing import shared_memory
+            except ImportError:
+                pass
+            else:
+                shm = shared_memory.SharedMemory(create=True, size=len(state))
+                shm.buf[:len(state)] = state
+                state = (shm.name, len(state))
+
+        try:
+            with ProcessPoolExecutor(max_workers=number_of_processes,
+                                     mp_context=ctx,
+                                     initializer=_init_worker,
+                                     initargs=(state, lock,
+                                               registry)) as executor:
+
+                for msgs in executor.map(worker, batches):
+                    if verbosity > 1:
+                        for msg in msgs:
+                            print(indent2 + msg)
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+            # results saved by workers are merged even if a task failed
+            if per_process:
+                parts = set()
+                while not registry.empty():
+                    parts.add(registry.get())
+                fileio.merge_hdf(output['file_name'], sorted(parts),
+                                 path=output['path'],
+                                 force=output['force_overwrite'], remove=True,
+                                 **output.get('h5_opts', {}))
 
         return True
 
 
-def worker(tasks_to_accomplish, tasks_that_are_done, module, lock, output,
-           verbosity):
+def compile_entry(key_list):
+    """Create function replacing an entry in a nested dictionary
 
-    this = mp.current_process().name
+    The returned function `replace(nested, value)` copies dictionaries along
+    the path and shares all other content. Keys are hard-coded in generated
+    source, which avoids looping over the path for every task.
+    """
 
-    if verbosity > 1:
-        print(indent2 + 'starting ' + this)
+    lines = ['def replace(nested, value):', '    node = out = nested.copy()']
+    for key in key_list[:-1]:
+        line = '    node[{0!r}] = node = node[{0!r}].copy()'
+        lines.append(line.format(key))
+    lines += [
+        '    sub = node[{!r}]'.format(key_list[-1]),
+        '    if isinstance(sub, list):',
+        '        sub = [value] + sub[1:]',
+        '    else:',
+        '        sub = value',
+        '    node[{!r}] = sub'.format(key_list[-1]),
+        '    return out',
+    ]
 
-    while True:
-        try:
-            # retrieve next simulation task
-            task, config, kwargs = tasks_to_accomplish.get_nowait()
+    namespace = {}
+    exec('\n'.join(lines), namespace)
 
-        except queue.Empty:
-            # no tasks left
-            if verbosity > 1:
-                print(indent2 + 'terminating ' + this)
-            break
+    return namespace['replace']
 
-        else:
 
-            obj = Simulation.from_module(module, output)
+@lru_cache(maxsize=None)
+def _replace_entry(key_list):
+    """Return entry setter for path (hidden function; cached)"""
+    return compile_entry(key_list)
+
+
+# worker process state (set by _init_worker)
+_worker = {}
+
+
+def _init_worker(state, lock, registry):
+    """Initialize worker process (hidden function)"""
+
+    import multiprocessing as mp
+
+    # serialized settings may be held in shared memory
+    if isinstance(state, tuple):
+        from multiprocessing import shared_memory
+        name, size = state
+        shm = shared_memory.SharedMemory(name=name)
+        state = bytes(shm.buf[:size])
+        shm.close()
 
-            # perform task
-            msg = indent1 + 'processing `{}` ({})'
+    module_name, defaults, entry_path, output, verbosity, kwargs = \
+        pickle.loads(state)
+
+    this = mp.current_process().name
+
+    if verbosity > 1:
+        print(indent2 + 'starting ' + this)
+
+    module = importlib.import_module(module_name)
+
+    # use separate output file if saving is not locked
+    part = None
+    if output is not None and lock is None:
+        output = output.copy()
+        part = '{}.{}.{}'.format(output['name'], os.getpid(),
+                                 output['format'])
+        output['file_name'] = part
+        fname = part
+        if output['path'] not in ['', None]:
+            fname = os.path.join(output['path'], part)
+        if os.path.isfile(fname):
+            os.remove(fname)
+        registry.put(part)
+
+    obj = Simulation.from_module(module, output)
+    obj._lock = lock
+
+    _worker.update({
+        'name': this,
+        'obj': obj,
+        'defaults': defaults,
+        'replace_entry': _replace_entry(entry_path),
+        'verbosity': verbosity,
+        'kwargs': kwargs,
+    })
+
+
+def worker(batch):
+    """Run a batch of tasks within a worker process"""
+
+    this = _worker['name']
+    obj = _worker['obj']
+    verbosity = _worker['verbosity']
+    replace_entry = _worker['replace_entry']
+    defaults = _worker['defaults']
+
+    # perform tasks (messages are only formatted if they are shown)
+    done = []
+
+    def configs():
+        for task, value in batch:
             if verbosity > 0:
-                print(msg.format(task, this))
-            obj.run(task, config, **kwargs)
-            with lock:
-                obj._save()
+                print(indent1 + 'processing `{}` ({})'.format(task, this))
+            yield task, replace_entry(defaults, value)
+            if verbosity > 1:
+                done.append('case `{}` completed by {}'.format(task, this))
 
-            msg = 'case `{}` completed by {}'.format(task, this)
-            tasks_that_are_done.put(msg)
+    obj.run_many(configs(), **_worker['kwargs'])
 
-    return True
+    return done
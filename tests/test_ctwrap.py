@@ -10,14 +10,57 @@ warnings.filterwarnings(action='once')
 warnings.filterwarnings("ignore", ".*Using or importing the ABCs from *")
 
 import os
+import sys
+import types
+import pickle
+import tempfile
+from copy import deepcopy
 
 import logging
 
+import pandas as pd
+
 import ctwrap as cw
 
 path = 'ctwrap/examples'
 
 
+def sweep_module(fail=None, group=None):
+    """Create module returning one data frame per task (fails for `fail`)
+
+    Results are saved to group `group` if specified, else to the task name.
+    """
+
+    module = types.ModuleType('ctwrap_test_sweep')
+
+    def defaults():
+        return {'value': 0.}
+
+    def run(name, value=0.):
+        if value == fail:
+            raise RuntimeError('task `{}` failed'.format(name))
+        return {group or name: pd.DataFrame({'value': [value]})}
+
+    module.defaults = defaults
+    module.run = run
+
+    # registered to be importable by (forked) worker processes
+    sys.modules[module.__name__] = module
+
+    return module
+
+
+def sweep_content(values, fname):
+    """Create handler input for `sweep_module`"""
+
+    return {
+        'ctwrap': '0.1.0',
+        'defaults': {'value': 0.},
+        'variation': {'entry': 'value', 'values': values},
+        'output': {'name': fname},
+    }
+
+
 class TestCtwrap(unittest.TestCase):
     def test000_parser(self):
 
@@ -36,6 +79,27 @@ class TestCtwrap(unittest.TestCase):
 
         self.assertTrue(success)
 
+    def test001_yaml_cache(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'cached.yaml')
+            with open(fname, 'w') as yml:
+                yml.write('defaults:\n  sleep: 0.2\n')
+
+            first = cw.fileio.load_yaml('cached.yaml', path=tmp)
+            first['defaults']['sleep'] = 0.4  # must not poison the cache
+            second = cw.fileio.load_yaml('cached.yaml', path=tmp)
+            self.assertEqual(second['defaults']['sleep'], 0.2)
+
+            # modified files are parsed again
+            with open(fname, 'w') as yml:
+                yml.write('defaults:\n  sleep: 0.6\n')
+            os.utime(fname, ns=(0, os.stat(fname).st_mtime_ns + 1))
+            third = cw.fileio.load_yaml('cached.yaml', path=tmp)
+            self.assertEqual(third['defaults']['sleep'], 0.6)
+
+            cw.fileio.load_yaml.cache_clear()
+
     def test010_minimal(self):
 
         try:
@@ -81,6 +145,149 @@ class TestCtwrap(unittest.TestCase):
 
         self.assertTrue(success)
 
+    def test014_configuration(self):
+
+        content = {
+            'ctwrap': '0.1.0',
+            'defaults': {'initial': {'phi': [1., 'dimensionless'], 'T': 300.}},
+            'variation': {'entry': 'initial.phi', 'values': [0.5, 2.]},
+            'output': {'format': None},
+        }
+        sh = cw.SimulationHandler.from_dict(content)
+
+        config = sh.configuration('initial.phi_0.5')
+        self.assertEqual(config['initial']['phi'], [0.5, 'dimensionless'])
+        self.assertEqual(config['initial']['T'], 300.)
+        self.assertEqual(sh['initial.phi_2.0']['initial']['phi'][0], 2.)
+
+        # defaults are not modified
+        self.assertEqual(content['defaults']['initial']['phi'][0], 1.)
+
+        # returned configurations are independent
+        config['initial']['T'] = 600.
+        config['initial']['phi'][1] = 'percent'
+        self.assertEqual(content['defaults']['initial']['T'], 300.)
+        self.assertEqual(sh['initial.phi_0.5']['initial']['T'], 300.)
+        self.assertEqual(sh['initial.phi_0.5']['initial']['phi'][1],
+                         'dimensionless')
+
+        # handlers can be copied and pickled
+        for other in [deepcopy(sh), pickle.loads(pickle.dumps(sh))]:
+            self.assertEqual(other['initial.phi_2.0'], sh['initial.phi_2.0'])
+
+    def test015_merge_hdf(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            frames = {'a': pd.DataFrame({'x': [1., 2.]}),
+                      'b': pd.DataFrame({'x': [3.]})}
+            cw.fileio.to_hdf('a.h5', {'a': frames['a']}, path=tmp)
+            cw.fileio.to_hdf('b.h5', {'b': frames['b']}, path=tmp)
+            cw.fileio.to_hdf('out.h5', {'a': frames['b']}, path=tmp)
+
+            # existing groups are protected
+            with self.assertRaises(RuntimeError):
+                cw.fileio.merge_hdf('out.h5', ['a.h5'], path=tmp, force=False)
+
+            cw.fileio.merge_hdf('out.h5', ['a.h5', 'b.h5', 'missing.h5'],
+                                path=tmp, remove=True)
+            out = cw.fileio.from_hdf('out.h5', path=tmp)
+            self.assertEqual(sorted(out), ['a', 'b'])
+            for g in frames:
+                pd.testing.assert_frame_equal(out[g], frames[g])
+            self.assertEqual(os.listdir(tmp), ['out.h5'])
+
+    def test016_parallel_file_per_process(self):
+
+        values = [1., 2., 3., 4., 5., 6.]
+        with tempfile.TemporaryDirectory() as tmp:
+            sim = cw.Simulation.from_module(sweep_module(fail=4.))
+            sh = cw.SimulationHandler.from_dict(
+                sweep_content(values, 'sweep'), path=tmp)
+
+            with self.assertRaises(RuntimeError):
+                sh.run_parallel(sim, number_of_processes=2, chunksize=1)
+
+            # results of completed tasks are merged; part files are removed
+            self.assertEqual(os.listdir(tmp), ['sweep.h5'])
+            groups = cw.fileio.h5ls('sweep.h5', path=tmp)
+            tasks = ['value_{}'.format(v) for v in values if v != 4.]
+            self.assertEqual(sorted(set(groups) - {'defaults', 'variation'}),
+                             tasks)
+
+    def test017_hdf_options(self):
+
+        import tables
+
+        params = cw.fileio.h5._cache_params(rdcc_nbytes=1 << 20,
+                                            rdcc_nslots=521,
+                                            rdcc_w0=.5,
+                                            mdc_nbytes=2 << 20)
+        self.assertEqual(params, {'CHUNK_CACHE_SIZE': 1 << 20,
+                                  'CHUNK_CACHE_NELMTS': 521,
+                                  'CHUNK_CACHE_PREEMPT': .5,
+                                  'METADATA_CACHE_SIZE': 2 << 20})
+
+        content = sweep_content([1., 2.], 'options')
+        content['output'].update({
+            'compression': 'gzip',
+            'compression_opts': 3,
+            'hdf5_rdcc': {'rdcc_nbytes': 1 << 20, 'rdcc_nslots': 521},
+            'hdf5_mdc_nbytes': 2 << 20,
+        })
+        with tempfile.TemporaryDirectory() as tmp:
+            sim = cw.Simulation.from_module(sweep_module())
+            sh = cw.SimulationHandler.from_dict(content, path=tmp)
+            sh.run_serial(sim)
+
+            out = cw.fileio.from_hdf('options.h5', path=tmp)
+            self.assertEqual(out['defaults'], {'value': 0.})
+            pd.testing.assert_frame_equal(out['value_2.0'],
+                                          pd.DataFrame({'value': [2.]}))
+
+            # metadata and results share compression settings (object
+            # arrays are stored without compression by pandas)
+            fname = os.path.join(tmp, 'options.h5')
+            with tables.open_file(fname) as hdf:
+                for g in ['defaults', 'value_1.0', 'value_2.0']:
+                    leaves = list(hdf.get_node('/', g)._f_walknodes('CArray'))
+                    self.assertTrue(leaves)
+                    for leaf in leaves:
+                        self.assertEqual(leaf.filters.complib, 'zlib')
+                        self.assertEqual(leaf.filters.complevel, 3)
+
+    def test018_run_many_failure(self):
+
+        values = [1., 2., 3., 4.]
+        with tempfile.TemporaryDirectory() as tmp:
+            sim = cw.Simulation.from_module(sweep_module(fail=3.))
+            sh = cw.SimulationHandler.from_dict(
+                sweep_content(values, 'failure'), path=tmp)
+
+            # results of earlier tasks in the same batch are saved
+            with self.assertRaises(RuntimeError):
+                sh.run_serial(sim)
+            groups = cw.fileio.h5ls('failure.h5', path=tmp)
+            self.assertIn('value_1.0', groups)
+            self.assertIn('value_2.0', groups)
+            self.assertNotIn('value_4.0', groups)
+
+    def test019_parallel_group_collision(self):
+
+        content = sweep_content([1., 2., 3.], 'collision')
+        content['output'].update({
+            'force_overwrite': False,
+            'parallel_strategy': 'lock',
+        })
+        with tempfile.TemporaryDirectory() as tmp:
+            sim = cw.Simulation.from_module(sweep_module(group='result'))
+            sh = cw.SimulationHandler.from_dict(content, path=tmp)
+
+            # repeated group names within a batch are not replaced silently
+            with self.assertRaises(RuntimeError):
+                sh.run_parallel(sim, number_of_processes=1, chunksize=3)
+            out = cw.fileio.from_hdf('collision.h5', path=tmp)
+            self.assertEqual(out['result']['value'][0], 1.)
+
     def test020_ignition(self):
 
         try: